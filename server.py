@@ -1,10 +1,20 @@
-from aiohttp import web, ClientSession
+from aiohttp import web, ClientError, ClientSession, ClientTimeout, \
+    TCPConnector
+import aiofiles
 import asyncio
+import hashlib
+import hmac
 import json
 import os
 import sys
+import time
+import traceback
 import urllib.parse
 import yaml
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 ###############################################################################
 # Configuration
@@ -16,10 +26,25 @@ def load_config():
 
     with open(sys.argv[1], 'r') as f:
         try:
-            config = yaml.safe_load(f)
+            config = yaml.load(f, Loader=YamlLoader)
         except Exception as exc:
             print('Loading config failed')
             raise
+
+    # precompute API base urls and headers used on every API call
+    for repo_cfg in config['repos'].values():
+        gh = repo_cfg['github']
+        gl = repo_cfg['gitlab']
+        proj = urllib.parse.quote(gl['repo'], safe='')
+        repo_cfg['_github_base'] = f"https://api.github.com/repos/{gh['repo']}"
+        repo_cfg['_github_hs'] = {
+            'Accept': 'application/vnd.github+json',
+            'Authorization': f"Bearer {gh['access_token']}",
+            'X-GitHub-Api-Version': '2022-11-28'
+            }
+        repo_cfg['_gitlab_base'] = \
+            f"https://{gl['host']}/api/v4/projects/{proj}"
+        repo_cfg['_gitlab_hs'] = {'PRIVATE-TOKEN': gl['access_token']}
     return config
 
 #repo_path = '/repo'
@@ -35,7 +60,10 @@ def gitlab_url(repo_config):
 ###############################################################################
 # Dealing with git repo
 
-git_queue = asyncio.Queue()
+# queue of repo paths with pending updates, each repo is queued at most once
+git_queue = asyncio.Queue(maxsize=256)
+# refs to sync for queued repos: path -> (cfg, refs), refs None means mirror
+git_pending = {}
 
 # Helper for running subprocesses
 async def run(parts, **kwargs):
@@ -52,27 +80,80 @@ async def run(parts, **kwargs):
 async def git_run(cfg, parts):
     await run(['/usr/bin/git'] + parts, cwd=cfg['path'])
 
-# pull all refs from github push them to gitlab
-async def git_pull_push(cfg, ):
-    await git_run(cfg, ['remote', 'update', '-p'])
-    # show refs just for debugging
-    await git_run(cfg, ['show-ref'])
-    await git_run(cfg, ['push', '--mirror', gitlab_url(cfg)])
+# pull refs from github and push them to gitlab, if refs is None all refs are
+# mirrored, otherwise only the specified (github ref, local ref) pairs
+async def git_pull_push(cfg, refs=None):
+    if refs is None:
+        await git_run(cfg, ['remote', 'update', '-p'])
+        # show refs just for debugging
+        if os.environ.get('GGSYNC_DEBUG'):
+            await git_run(cfg, ['show-ref'])
+        await git_run(cfg, ['push', '--mirror', gitlab_url(cfg)])
+        return
+
+    try:
+        await git_run(cfg, ['fetch', 'origin'] +
+            [f'+{src}:{local}' for (src,local) in refs])
+        await git_run(cfg, ['push', gitlab_url(cfg)] +
+            [f'+{local}:{local}' for (_,local) in refs])
+    except Exception as exc:
+        # e.g. the ref was deleted on github in the meantime
+        print('Targeted push-pull failed, falling back to mirror:', exc)
+        await git_pull_push(cfg)
+
+# check that a ref from a webhook payload is a plain branch or tag name that
+# is safe to use in a refspec
+def ref_ok(ref):
+    if not isinstance(ref, str):
+        return False
+    if not ref.startswith('refs/heads/') and not ref.startswith('refs/tags/'):
+        return False
+    if '..' in ref or any(c in ref for c in ':*?[\\^~') or \
+            any(c.isspace() for c in ref):
+        return False
+    return True
+
+# determine refs affected by a github event, returns None if unknown
+def event_refs(op, x):
+    if not isinstance(x, dict):
+        return None
+    try:
+        if op == 'push':
+            # deletions are only propagated by a full mirror
+            if x.get('deleted'):
+                return None
+            ref = x['ref']
+            if not ref_ok(ref):
+                return None
+            return [(ref, ref)]
+        elif op == 'pull_request':
+            # matches the refs/pull/* -> refs/heads/pull/* fetch mapping. The
+            # merge ref is missing for PRs with conflicts, the failing fetch
+            # then falls back to a full mirror.
+            n = int(x['number'])
+            return [(f'refs/pull/{n}/head', f'refs/heads/pull/{n}/head'),
+                (f'refs/pull/{n}/merge', f'refs/heads/pull/{n}/merge')]
+    except (KeyError, TypeError, ValueError):
+        pass
+    return None
 
 
 # clone repo from github and pull-push once
 async def init_git(cfg):
     print('Initializing local git repo')
     # note that we cannot use git_run yet here as /repo does not exist yet
-    await run(['/usr/bin/git', 'clone', '--bare', '--mirror', github_url(cfg),
-        cfg['path']])
-    # make sure we fetch all refs on future updates
-    await git_run(cfg, ['config', '--add', 'remote.origin.fetch',
-        '+refs/*:refs/*'])
-    # Important tweak: add branch head refs for pull requests so they show up
-    # as branches in gitlab!
-    await git_run(cfg, ['config', '--add', 'remote.origin.fetch',
-        '+refs/pull/*:refs/heads/pull/*'])
+    # blobs are not fetched upfront (partial clone, needs git >= 2.27), git
+    # lazily fetches the ones it needs from github when pushing to gitlab.
+    # Config is passed to clone directly to avoid spawning a git process per
+    # setting. --mirror already makes sure we fetch all refs on updates.
+    await run(['/usr/bin/git', 'clone', '--bare', '--mirror',
+        '--filter=blob:none',
+        '-c', 'remote.origin.promisor=true',
+        '-c', 'remote.origin.partialclonefilter=blob:none',
+        # Important tweak: add branch head refs for pull requests so they show
+        # up as branches in gitlab!
+        '-c', 'remote.origin.fetch=+refs/pull/*:refs/heads/pull/*',
+        github_url(cfg), cfg['path']])
     await git_pull_push(cfg)
 
 # Task sequentially executing operations on the git repo in the background
@@ -80,83 +161,144 @@ async def git_task():
     for n,cfg in config['repos'].items():
         await init_git(cfg)
     while True:
-        (cfg,_,op) = await git_queue.get()
-        print('Git Task: initiating push-pull')
-        await git_pull_push(cfg)
+        path = await git_queue.get()
+        (cfg, refs) = git_pending.pop(path)
+        print('Git Task: initiating push-pull', refs)
+        try:
+            await git_pull_push(cfg, refs)
+        except Exception as exc:
+            print('Git Task: push-pull failed:', exc)
+
+# queue a github event for the git task. If the repo is already queued, the
+# affected refs are merged into its pending update, as a single push-pull
+# picks up all refs updated by a burst of events. Raises asyncio.QueueFull if
+# the queue is full.
+def git_enqueue(cfg, op, x):
+    refs = event_refs(op, x)
+    path = cfg['path']
+    if path in git_pending:
+        (_,prev) = git_pending[path]
+        if prev is None or refs is None:
+            git_pending[path] = (cfg, None)
+        else:
+            git_pending[path] = (cfg, prev + [r for r in refs if r not in prev])
+        return
 
+    git_queue.put_nowait(path)
+    git_pending[path] = (cfg, refs)
 
 
+###############################################################################
+# Issuing API requests
+
+api_attempts = 3
+api_backoff = 0.5
+
+# seconds to wait until the rate limit of the API is reset, or None if the
+# limit is not exhausted
+def rate_limit_wait(resp):
+    if resp.headers.get('X-RateLimit-Remaining') != '0':
+        return None
+    try:
+        return max(0, float(resp.headers['X-RateLimit-Reset']) - time.time())
+    except (KeyError, ValueError):
+        return None
+
+# Send an HTTP request, retrying with exponential backoff on rate limiting,
+# server errors and connection failures. Honors Retry-After and waits for the
+# rate limit to reset when it is exhausted.
+async def api_request(session, method, url, **kwargs):
+    backoff = api_backoff
+    for attempt in range(api_attempts):
+        last = attempt == api_attempts - 1
+        try:
+            resp = await session.request(method, url, **kwargs)
+        except (ClientError, asyncio.TimeoutError) as exc:
+            if last:
+                raise
+            print('API request failed, retrying:', url, exc)
+            await asyncio.sleep(backoff)
+            backoff *= 2
+            continue
+
+        limit_wait = rate_limit_wait(resp)
+        retry = resp.status == 429 or resp.status >= 500 or \
+            (resp.status == 403 and (limit_wait is not None or
+                'Retry-After' in resp.headers))
+        if not retry or last:
+            if limit_wait is not None and not retry:
+                print('API rate limit exhausted, waiting', limit_wait, 's')
+                await asyncio.sleep(limit_wait)
+            return resp
+
+        try:
+            wait = float(resp.headers['Retry-After'])
+        except (KeyError, ValueError):
+            wait = limit_wait if limit_wait is not None else backoff
+        print('API request returned', resp.status, 'retrying in', wait, 's:',
+                url)
+        resp.release()
+        await asyncio.sleep(wait)
+        backoff *= 2
+
 ###############################################################################
 # Dealing with github api
 
 # Send a POST request to github API
-async def github_post(cfg, ep, data, args={}):
-    url = f"https://api.github.com/repos/{cfg['github']['repo']}/{ep}"
-    first = True
-    for k,v in args.items():
-        url += '&' if not first else '?'
-        first = False
-        url += k + '=' + v
-
-    print('Invoking github API:', url)
-
-    hs = {
-        'Accept': 'application/vnd.github+json',
-        'Authorization': f"Bearer {cfg['github']['access_token']}",
-        'X-GitHub-Api-Version': '2022-11-28'
-        }
+async def github_post(session, cfg, ep, data, args={}):
+    url = cfg['_github_base'] + '/' + ep
+    print('Invoking github API:', url, args)
 
-    resp = await http_client.post(url, data=json.dumps(data), headers=hs)
+    resp = await api_request(session, 'post', url, json=data,
+            headers=cfg['_github_hs'], params=args)
 
-    text = await resp.text()
     if resp.status != 200 and resp.status != 201:
-        print(text)
+        print(await resp.text())
         print(resp.status)
         raise Exception('github API call failed')
-    return json.loads(text)
+    return await resp.json()
 
 # Set Github Commit status
-async def github_commit_status_set(cfg, commit, context, status, desc, url):
+async def github_commit_status_set(session, cfg, commit, context, status,
+        desc, url):
     data = {
         'state': status,
         'target_url': url,
         'description': desc,
         'context': context
         }
-    await github_post(cfg, 'statuses/' + commit, data=data)
+    await github_post(session, cfg, 'statuses/' + commit, data=data)
 
 ###############################################################################
 # Dealing with gitlab api
 
-gitlab_queue = asyncio.Queue()
-
-async def gitlab_get(cfg, ep, method='get', args={}):
-    proj = urllib.parse.quote(cfg['gitlab']['repo'], safe='')
-    url = f"https://{cfg['gitlab']['host']}/api/v4/projects/{proj}/{ep}"
-    first = True
-    for k,v in args.items():
-        url += '&' if not first else '?'
-        first = False
-        url += k + '=' + v
-
-    print('Invoking gitlab API:', url)
+gitlab_queue = asyncio.Queue(maxsize=1024)
 
-    hs = {'PRIVATE-TOKEN': cfg['gitlab']['access_token']}
+async def gitlab_get(session, cfg, ep, method='get', args={}):
+    url = cfg['_gitlab_base'] + '/' + ep
+    print('Invoking gitlab API:', url, args)
 
-    if method == 'get':
-        resp = await http_client.get(url, headers=hs)
-    elif method == 'post':
-        resp = await http_client.post(url, headers=hs)
-    else:
+    if method != 'get' and method != 'post':
         raise Exception('unsupported method')
-    text = await resp.text()
+    resp = await api_request(session, method, url, headers=cfg['_gitlab_hs'],
+            params=args)
     if resp.status != 200:
-        print(text)
+        print(await resp.text())
         raise Exception('gitlab API call failed')
-    return json.loads(text)
+    return await resp.json()
+
 
+# pending github status updates: (repo, commit, context) ->
+# (cfg, status, description, url). Updates are collected and flushed
+# periodically, so quickly superseded statuses of a job (e.g. created ->
+# pending -> running) are only sent to github once.
+pending_statuses = {}
+status_flush_interval = 0.5
+# failed flush attempts per pending status key, given up after the maximum
+status_failures = {}
+status_retries_max = 5
 
-async def commit_status_set(cfg, commit, test, status, url):
+def commit_status_set(cfg, commit, test, status, url):
     if status == 'success':
         gh_status = 'success'
     elif status == 'pending' or status == 'created' or status == 'running':
@@ -171,25 +313,138 @@ async def commit_status_set(cfg, commit, test, status, url):
     if 'job_descriptions' in cfg['gitlab']:
         description = cfg['gitlab']['job_descriptions'].get(test, description)
 
-    await github_commit_status_set(cfg, commit, 'gitlab/' + test, gh_status,
-            description, url)
+    context = 'gitlab/' + test
+    pending_statuses[(cfg['github']['repo'], commit, context)] = \
+        (cfg, gh_status, description, url)
+
+# statuses last sent to github: repo -> {'commit context': [status, desc, url]}
+# Identical updates are skipped. If a repo has status_state_path configured,
+# this is persisted so restarts do not re-send all statuses in init_statuses.
+sent_statuses = {}
+
+# maximum number of jobs fetched per pipeline by init_statuses
+init_jobs_per_pipeline = 100
+
+# number of sent statuses remembered per repo: room for everything
+# init_statuses records, plus the same again for later updates
+def sent_statuses_max(cfg):
+    return 2 * cfg['gitlab']['initial_pipeline_sync'] * init_jobs_per_pipeline
+
+def sent_statuses_load(cfg):
+    sent = {}
+    path = cfg.get('status_state_path')
+    if path is not None:
+        try:
+            with open(path, 'r') as f:
+                sent = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as exc:
+            print('Loading status state failed, ignoring:', exc)
+    if not isinstance(sent, dict):
+        print('Invalid status state, ignoring')
+        sent = {}
+    sent_statuses[cfg['github']['repo']] = sent
+
+async def sent_statuses_save(cfg):
+    path = cfg.get('status_state_path')
+    if path is None:
+        return
+    data = json.dumps(sent_statuses[cfg['github']['repo']])
+    async with aiofiles.open(path + '.tmp', 'w') as f:
+        await f.write(data)
+    os.replace(path + '.tmp', path)
+
+# limits concurrent status updates to stay clear of github's secondary rate
+# limits
+commit_status_sem = asyncio.Semaphore(10)
+
+async def commit_status_flush_one(session, cfg, commit, context, status, desc,
+        url):
+    async with commit_status_sem:
+        await github_commit_status_set(session, cfg, commit, context, status,
+                desc, url)
+
+# Task periodically sending pending status updates to github concurrently.
+# Failures are logged but do not abort the other updates. Once stop is set,
+# the remaining pending updates are flushed and the task exits.
+async def commit_status_task(session, stop):
+    while True:
+        try:
+            await asyncio.wait_for(stop.wait(), status_flush_interval)
+        except asyncio.TimeoutError:
+            pass
+        stopping = stop.is_set()
+        await commit_status_flush(session)
+        if stopping:
+            return
+
+# Send all pending status updates to github
+async def commit_status_flush(session):
+    global pending_statuses
+    if not pending_statuses:
+        return
+    updates = []
+    for ((repo,commit,context),(cfg,*st)) in pending_statuses.items():
+        if sent_statuses[repo].get(f'{commit} {context}') != st:
+            updates.append((cfg, commit, context, st))
+    pending_statuses = {}
+
+    res = await asyncio.gather(
+        *[commit_status_flush_one(session, cfg, commit, context, *st)
+            for (cfg,commit,context,st) in updates],
+        return_exceptions=True)
+
+    changed = {}
+    for ((cfg,commit,context,st),r) in zip(updates, res):
+        key = (cfg['github']['repo'], commit, context)
+        if isinstance(r, Exception):
+            print('Setting commit status failed:', commit, context, r)
+            # retry with the next flush, unless superseded meanwhile
+            failures = status_failures.pop(key, 0) + 1
+            if key in pending_statuses:
+                pass
+            elif failures >= status_retries_max:
+                print('Giving up on commit status:', commit, context)
+            else:
+                status_failures[key] = failures
+                pending_statuses[key] = (cfg, *st)
+            continue
+        status_failures.pop(key, None)
+        # re-insert to keep the most recently updated entries at the end
+        sent = sent_statuses[cfg['github']['repo']]
+        sent.pop(f'{commit} {context}', None)
+        sent[f'{commit} {context}'] = st
+        while len(sent) > sent_statuses_max(cfg):
+            del sent[next(iter(sent))]
+        changed[cfg['github']['repo']] = cfg
+
+    for cfg in changed.values():
+        try:
+            await sent_statuses_save(cfg)
+        except Exception as exc:
+            print('Saving status state failed:', exc)
 
 # fetch most recent pipelines
-async def init_statuses(cfg):
+async def init_statuses(session, cfg):
     print('initializing commit statuses')
-    pls = await gitlab_get(cfg, 'pipelines', args={
+    pls = await gitlab_get(session, cfg, 'pipelines', args={
         'pagination': 'keyset',
         'order_by': 'updated_at',
         'sort': 'desc',
         'per_page': str(cfg['gitlab']['initial_pipeline_sync']),
         })
-    for pl in pls:
-        plid = pl['id']
-        jobs = await gitlab_get(cfg, f'pipelines/{plid}/jobs',
-                args={'per_page': '100'})
+    jobs_lists = await asyncio.gather(*[
+        gitlab_get(session, cfg, f"pipelines/{pl['id']}/jobs",
+            args={'per_page': str(init_jobs_per_pipeline)})
+        for pl in pls])
+
+    # oldest pipeline first, so the sent statuses are recorded (and evicted)
+    # in order of pipeline age
+    for jobs in reversed(jobs_lists):
         for j in jobs:
-            await commit_status_set(cfg, j['commit']['id'], j['name'],
-                    j['status'], j['web_url'])
+            commit_status_set(cfg, j['commit']['id'], j['name'], j['status'],
+                    j['web_url'])
     print('Commit statuses initialized')
 
 async def gitlab_update_pipeline(cfg, event):
@@ -197,70 +452,178 @@ async def gitlab_update_pipeline(cfg, event):
     for j in event['builds']:
         jid = j['id']
         url = f"https://{cfg['gitlab']['host']}/{cfg['gitlab']['repo']}/-/jobs/{jid}"
-        await commit_status_set(cfg, cid, j['name'], j['status'], url)
-
-# Task sequentially executing operations on the git repo in the background
-async def gitlab_task():
-    for n,cfg in config['repos'].items():
-        await init_statuses(cfg)
+        commit_status_set(cfg, cid, j['name'], j['status'], url)
 
+# Worker processing gitlab events from the queue
+async def gitlab_worker():
     while True:
         (cfg, t, ev) = await gitlab_queue.get()
         print('GitLab Task: processing event', t)
-        if t == 'Pipeline Hook':
-            await gitlab_update_pipeline(cfg, ev)
-        else:
-            raise Exception('Unknown event type')
+        try:
+            if t == 'Pipeline Hook':
+                await gitlab_update_pipeline(cfg, ev)
+            else:
+                raise Exception('Unknown event type')
+        except Exception as exc:
+            print('GitLab Task: processing event failed:', exc)
+
+async def init_all_statuses(session):
+    for n,cfg in config['repos'].items():
+        try:
+            await init_statuses(session, cfg)
+        except Exception as exc:
+            print('Initializing commit statuses failed:', exc)
+
+# Task initializing statuses and processing gitlab events in the background.
+# The worker runs from the start so events are not held up if gitlab is
+# unavailable during the initial sync.
+async def gitlab_task(session):
+    for n,cfg in config['repos'].items():
+        sent_statuses_load(cfg)
+
+    await asyncio.gather(gitlab_worker(), init_all_statuses(session))
 
 ###############################################################################
 # REST API
 
 routes = web.RouteTableDef()
 
+# references to pending enqueue tasks so they are not garbage collected
+enqueue_tasks = set()
+
+# Put an event into a queue in the background, dropping it if the queue
+# stays full, so webhook requests can be answered right away.
+async def enqueue(queue, item):
+    try:
+        await asyncio.wait_for(queue.put(item), timeout=0.05)
+    except asyncio.TimeoutError:
+        print('Queue full, dropping event', item[1])
+
+def enqueue_bg(queue, item):
+    task = asyncio.create_task(enqueue(queue, item))
+    enqueue_tasks.add(task)
+    task.add_done_callback(enqueue_tasks.discard)
+
+# Check github webhook signature if a secret is configured
+def github_signature_ok(repo_cfg, request, body):
+    secret = repo_cfg['github'].get('webhook_secret')
+    if secret is None:
+        return True
+    sig = request.headers.get('x-hub-signature-256', '')
+    mac = hmac.new(str(secret).encode(), body, hashlib.sha256)
+    return hmac.compare_digest(sig.encode('utf-8', 'surrogateescape'),
+            ('sha256=' + mac.hexdigest()).encode())
+
+# Check gitlab webhook token if a secret is configured
+def gitlab_token_ok(repo_cfg, request):
+    secret = repo_cfg['gitlab'].get('webhook_secret')
+    if secret is None:
+        return True
+    token = request.headers.get('x-gitlab-token', '')
+    return hmac.compare_digest(token.encode('utf-8', 'surrogateescape'),
+            str(secret).encode())
+
 @routes.post('/{repo}/github')
 async def github(request):
     repo_cfg = config['repos'][request.match_info['repo']]
     ev = request.headers['x-github-event']
-    x = await request.json()
-    if ev == 'push':
-        print('Handling github push event...')
-        await git_queue.put((repo_cfg, 'push', x))
-    elif ev == 'pull_request':
-        print('Handling github pull request event...')
-        await git_queue.put((repo_cfg, 'push', x))
-    else:
-        print('Ignoring unknown github event', ev)
+    body = await request.read()
+    if not github_signature_ok(repo_cfg, request, body):
+        print('Rejecting github event with invalid signature')
+        return web.Response(status=401, text='Invalid signature')
+    x = json.loads(body)
+    if (ev == 'push' or ev == 'pull_request') and \
+            request.app[git_task_key].done():
+        # events would only pile up in git_pending
+        print('Git task not running, rejecting github event')
+        return web.Response(status=503, text='git sync not running')
+    try:
+        if ev == 'push':
+            print('Handling github push event...')
+            git_enqueue(repo_cfg, 'push', x)
+        elif ev == 'pull_request':
+            print('Handling github pull request event...')
+            git_enqueue(repo_cfg, 'pull_request', x)
+        else:
+            print('Ignoring unknown github event', ev)
+    except asyncio.QueueFull:
+        print('Git queue full, rejecting github event')
+        return web.Response(status=503, text='busy')
     return web.Response(text="OK")
 
 @routes.post('/{repo}/gitlab')
 async def gitlab(request):
     repo_cfg = config['repos'][request.match_info['repo']]
     ev = request.headers['x-gitlab-event']
+    if not gitlab_token_ok(repo_cfg, request):
+        print('Rejecting gitlab event with invalid token')
+        return web.Response(status=401, text='Invalid token')
     x = await request.json()
     if ev == 'Pipeline Hook':
         print('Handling gitlab pipeline event...')
-        await gitlab_queue.put((repo_cfg, ev, x))
+        enqueue_bg(gitlab_queue, (repo_cfg, ev, x))
     else:
         print('Ignoring unknown gitlab event', ev)
 
     return web.Response(text="OK")
 
-
 ###############################################################################
 
 # start by loading config
 config = load_config()
 
-loop = asyncio.get_event_loop()
-asyncio.set_event_loop(loop)
-
-http_client = ClientSession()
-
-# initialize local git repo
-loop.create_task(git_task())
-loop.create_task(gitlab_task())
+# report background tasks that died with an exception
+def task_done(task):
+    if task.cancelled():
+        return
+    exc = task.exception()
+    if exc is not None:
+        print('Background task', task.get_name(), 'failed:')
+        traceback.print_exception(type(exc), exc, exc.__traceback__)
+
+def start_task(coro):
+    task = asyncio.create_task(coro, name=coro.__name__)
+    task.add_done_callback(task_done)
+    return task
+
+http_key = web.AppKey('http', ClientSession)
+git_task_key = web.AppKey('git_task', asyncio.Task)
+tasks_key = web.AppKey('tasks', list)
+status_task_key = web.AppKey('status_task', asyncio.Task)
+status_stop_key = web.AppKey('status_stop', asyncio.Event)
+
+# create http session and start background tasks once the event loop runs
+async def on_startup(app):
+    # keep connections to the github/gitlab APIs alive and cache DNS lookups,
+    # as we mostly issue bursts of requests to the same two hosts
+    connector = TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=300,
+            keepalive_timeout=60, enable_cleanup_closed=True)
+    app[http_key] = ClientSession(connector=connector,
+            timeout=ClientTimeout(total=30))
+
+    # initialize local git repo
+    app[git_task_key] = start_task(git_task())
+    app[tasks_key] = [
+        app[git_task_key],
+        start_task(gitlab_task(app[http_key])),
+        ]
+    app[status_stop_key] = asyncio.Event()
+    app[status_task_key] = start_task(
+        commit_status_task(app[http_key], app[status_stop_key]))
+
+async def on_cleanup(app):
+    for t in app[tasks_key]:
+        t.cancel()
+    await asyncio.gather(*app[tasks_key], return_exceptions=True)
+    # no new status updates come in anymore, let the status task send the
+    # pending ones before closing the session
+    app[status_stop_key].set()
+    await asyncio.gather(app[status_task_key], return_exceptions=True)
+    await app[http_key].close()
 
 # start main REST API
 app = web.Application()
 app.add_routes(routes)
+app.on_startup.append(on_startup)
+app.on_cleanup.append(on_cleanup)
 web.run_app(app, port=3000)